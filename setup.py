@@ -10,7 +10,7 @@ setup(
     author_email='l.c.d.toit@usit.uio.no',
     url='https://github.com/unioslo/tsd-api-lib',
     packages=['tsdapilib'],
-    install_requires=['blake3'],
+    install_requires=['blake3', 'psycopg', 'psycopg-pool'],
     python_requires='>=3.6',
 
 )
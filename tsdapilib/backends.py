@@ -1,22 +1,37 @@
 
-import psycopg2
-import psycopg2.extensions
-import psycopg2.pool
+import heapq
+import os
+import psycopg
+import psycopg_pool
 import sqlite3
+import threading
+import time
 
 from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import datetime, timedelta
 from typing import Optional, ContextManager, Any
 
+# bound once, since the clock is read on every operation
+_now = time.time
+
 
 class GenericBackend(object):
 
+    # upper bound on the number of fetched items kept
+    # in the in-process cache in front of the backend
+    lru_size = 4096
+
     def __init__(self, config: dict = {}, stale_after: int = 24) -> None:
         self._init_backend(config)
         self.purge()
         self._config = config
         self._stale_after = stale_after
+        # hours to seconds, once, rather than per put
+        self._stale_after_seconds = stale_after * 3600
+        # the cache is shared between the verifier's worker
+        # threads, so its operations are serialised by a lock
+        self._lru = OrderedDict()
+        self._lru_lock = threading.Lock()
 
     @property
     def config(self) -> dict:
@@ -29,44 +44,131 @@ class GenericBackend(object):
     def _init_backend(self, config: dict) -> None:
         raise NotImplementedError
 
-    def _put(self, reference: str, content_hash: str, stale_after: int) -> bool:
+    def _put(
+        self,
+        reference: str,
+        content_hash: str,
+        stale_after: int,
+        size: Optional[int] = None,
+        mtime: Optional[int] = None,
+    ) -> bool:
         # simple, atomic, idempotent put
         raise NotImplementedError
 
+    def _put_many(self, items: list) -> bool:
+        # put a list of (reference, content_hash, stale_after, size,
+        # mtime) tuples, in one transaction where the backend supports it
+        for reference, content_hash, stale_after, size, mtime in items:
+            self._put(reference, content_hash, stale_after, size, mtime)
+        return True
+
     def _get(self, reference: str) -> Optional[dict]:
         # simple, atomic get
         raise NotImplementedError
 
+    def _get_many(self, references: list) -> dict:
+        # get a dict of items for a list of references,
+        # in one query where the backend supports it
+        items = {}
+        for reference in references:
+            item = self._get(reference)
+            if item:
+                items[reference] = item
+        return items
+
     def _clean(self) -> bool:
         raise NotImplementedError
 
     # public methods
 
-    def store(self, reference: str, content_hash: str) -> bool:
+    def store(
+        self,
+        reference: str,
+        content_hash: str,
+        size: Optional[int] = None,
+        mtime: Optional[int] = None,
+    ) -> bool:
+        """
+        Persist a content reference and its hash digest, along with
+        the time after which it should be considered stale, and,
+        when known, the size and mtime of the content at hashing
+        time, so later checks can skip hashing unchanged files.
+
+        """
+        stale_after = int(_now()) + self._stale_after_seconds
+        with self._lru_lock:
+            self._lru.pop(reference, None)
+        return self._put(reference, content_hash, stale_after, size, mtime)
+
+    def store_many(self, items: list) -> bool:
         """
-        Persist a content reference and its hash digest,
-        along with the time after which it should be considered stale.
+        Persist a list of (reference, content_hash, size, mtime)
+        tuples in one operation, amortising the per-transaction
+        cost over the batch. Duplicate references collapse to their
+        last occurrence, as repeated single puts would leave behind
+        - the batched upserts cannot touch a row twice.
 
         """
-        stale_after = int((datetime.now() + timedelta(hours=self.stale_after)).timestamp())
-        return self._put(reference, content_hash, stale_after)
+        stale_after = int(_now()) + self._stale_after_seconds
+        unique = {
+            reference: (content_hash, size, mtime)
+            for reference, content_hash, size, mtime in items
+        }
+        with self._lru_lock:
+            for reference in unique:
+                self._lru.pop(reference, None)
+        return self._put_many(
+            [
+                (reference, content_hash, stale_after, size, mtime)
+                for reference, (content_hash, size, mtime) in unique.items()
+            ]
+        )
 
     def fetch(self, reference: str) -> Optional[dict]:
         """
         Fetch a reference, its hash, and expiry time from the store.
         If there is not item corresponding to the reference, or if
-        the reference has become stale, then return None.
+        the reference has become stale, then return None. Fetched
+        items are served from a small in-process cache while they
+        remain fresh, skipping the backend round trip - store()
+        invalidates the cached entry for its reference.
 
         """
-        now = datetime.now().timestamp()
+        now = _now()
+        with self._lru_lock:
+            item = self._lru.get(reference)
+            if item:
+                if now > item.get('stale_after'):
+                    self._lru.pop(reference, None)
+                else:
+                    self._lru.move_to_end(reference)
+                    return item
         item = self._get(reference)
         if not item:
             return None
         elif now > item.get('stale_after'):
             return None
         else:
+            with self._lru_lock:
+                self._lru[reference] = item
+                if len(self._lru) > self.lru_size:
+                    self._lru.popitem(last=False)
             return item
 
+    def fetch_many(self, references: list) -> dict:
+        """
+        Fetch many references in one operation, returning a dict
+        mapping each reference to its item, leaving out references
+        which are missing from the store, or have become stale.
+
+        """
+        now = _now()
+        items = self._get_many(references)
+        return {
+            reference: item for reference, item in items.items()
+            if now <= item.get('stale_after')
+        }
+
     def purge(self) -> None:
         """
         Remove all stale entries, in bulk.
@@ -78,61 +180,119 @@ class GenericBackend(object):
 class EphemeralBackend(GenericBackend):
 
     storage = OrderedDict()
+    # min-heap of (stale_after, reference) tuples, so that
+    # purging only ever touches the expired entries
+    expiry = []
 
     def _init_backend(self, config: dict) -> None:
         pass # nothing to do here
 
-    def _put(self, reference: str, content_hash: str, stale_after: int) -> bool:
+    def _put(
+        self,
+        reference: str,
+        content_hash: str,
+        stale_after: int,
+        size: Optional[int] = None,
+        mtime: Optional[int] = None,
+    ) -> bool:
         self.storage[reference] = {
             'reference': reference,
             'content_hash': content_hash,
             'stale_after': stale_after,
+            'size': size,
+            'mtime': mtime,
         }
+        heapq.heappush(self.expiry, (stale_after, reference))
 
     def _get(self, reference: str) -> Optional[dict]:
-        return self.storage.get('reference')
+        return self.storage.get(reference)
 
     def _clean(self) -> None:
-        new = {}
-        now = datetime.now().timestamp()
-        for k,v in self.storage:
-            if now < v.get('stale_after'):
-                new[k] = v
-        self.storage = new
+        now = _now()
+        while self.expiry and self.expiry[0][0] < now:
+            stale_after, reference = heapq.heappop(self.expiry)
+            item = self.storage.get(reference)
+            # an entry refreshed since this heap tuple was pushed
+            # leaves the tuple behind as a harmless tombstone
+            if item and item.get('stale_after') == stale_after:
+                del self.storage[reference]
 
 
 class GenericDataBaseBackend(GenericBackend):
 
+    # the digest is stored as its raw 32 bytes, rather than the
+    # 64 character hex string, halving the hash payload on disk
+    # and on the wire - the column type is dialect-specific
     table_definition = """
         content_hashes(
             reference text unique not null,
-            content_hash text not null,
-            stale_after int not null
+            content_hash {hash_column_type} not null,
+            stale_after int not null,
+            size bigint,
+            mtime bigint
         )
     """
+    hash_column_type = None
+
+    @staticmethod
+    def _encode_hash(content_hash: str) -> bytes:
+        return bytes.fromhex(content_hash)
+
+    @staticmethod
+    def _decode_hash(content_hash: Any) -> str:
+        return bytes(content_hash).hex()
 
     def _init_backend(self, config: dict) -> None:
         self.engine = self._db_init(config)
+        table_definition = self.table_definition.format(
+            hash_column_type=self.hash_column_type,
+        )
         with self._session_scope(self.engine) as session:
-            session.execute(f"create table if not exists {self.table_definition}")
+            session.execute(f"create table if not exists {table_definition}")
 
-    def _put(self, reference: str, content_hash: str, stale_after: int) -> bool:
+    def _put(
+        self,
+        reference: str,
+        content_hash: str,
+        stale_after: int,
+        size: Optional[int] = None,
+        mtime: Optional[int] = None,
+    ) -> bool:
         with self._session_scope(self.engine) as session:
             session.execute(
-                self._gen_put_sql(),
+                self.put_sql,
                 {
                     "reference": reference,
-                    "content_hash": content_hash,
+                    "content_hash": self._encode_hash(content_hash),
                     "stale_after": stale_after,
+                    "size": size,
+                    "mtime": mtime,
                 }
             )
         return True
 
+    def _put_many(self, items: list) -> bool:
+        with self._session_scope(self.engine) as session:
+            session.executemany(
+                self.put_sql,
+                [
+                    {
+                        "reference": reference,
+                        "content_hash": self._encode_hash(content_hash),
+                        "stale_after": stale_after,
+                        "size": size,
+                        "mtime": mtime,
+                    }
+                    for reference, content_hash, stale_after, size, mtime in items
+                ]
+            )
+        return True
+
     def _get(self, reference: str) -> Optional[dict]:
         rows = []
         with self._session_scope(self.engine) as session:
             session.execute(
-                self._gen_get_sql(),
+                self.get_sql,
                 {"reference": reference}
             )
             rows = session.fetchall()
@@ -143,13 +303,14 @@ class GenericDataBaseBackend(GenericBackend):
             item = {}
             for k,v in zip(cols, rows[0]):
                 item[k] = v
+            item['content_hash'] = self._decode_hash(item.get('content_hash'))
             return item
 
     def _clean(self) -> None:
         with self._session_scope(self.engine) as session:
             session.execute(
-                self._gen_clean_sql(),
-                {"now": datetime.now().timestamp()}
+                self.clean_sql,
+                {"now": _now()}
             )
 
     def _db_init(self, config: dict) -> Any:
@@ -161,14 +322,11 @@ class GenericDataBaseBackend(GenericBackend):
         # return a transactional scope
         raise NotImplementedError
 
-    def _gen_put_sql(self) -> str:
-        raise NotImplementedError
-
-    def _gen_get_sql(self) -> str:
-        raise NotImplementedError
-
-    def _gen_clean_sql(self) -> str:
-        raise NotImplementedError
+    # statement strings, bound once at class definition
+    # time by the subclasses, not rebuilt on every call
+    put_sql = None
+    get_sql = None
+    clean_sql = None
 
 
 class SQLiteBackend(GenericDataBaseBackend):
@@ -180,86 +338,194 @@ class SQLiteBackend(GenericDataBaseBackend):
         path = config.get('path')
         dbname = config.get('name')
         dburl = 'sqlite:///' + path + '/' + dbname
-        engine = sqlite3.connect(path + '/' + dbname)
+        # the connection is shared between threads,
+        # serialised by the lock in _session_scope
+        engine = sqlite3.connect(path + '/' + dbname, check_same_thread=False)
+        # write-ahead logging with relaxed syncing avoids an
+        # fsync per commit, while remaining crash-safe, and a
+        # larger cache plus mmap keeps reads off the disk
+        engine.execute("pragma journal_mode = wal")
+        engine.execute("pragma synchronous = normal")
+        engine.execute("pragma temp_store = memory")
+        engine.execute("pragma mmap_size = 268435456")
+        engine.execute("pragma cache_size = -65536")
+        self._lock = threading.Lock()
         return engine
 
+    def _clean(self) -> None:
+        super()._clean()
+        # fold the log back into the main database when
+        # convenient, leaving checkpointing otherwise to
+        # sqlite's auto-checkpoint
+        with self._session_scope(self.engine) as session:
+            session.execute("pragma wal_checkpoint(passive)")
+
     @contextmanager
     def _session_scope(
         self,
         engine: sqlite3.Connection,
     ) -> ContextManager[sqlite3.Cursor]:
+        self._lock.acquire()
         session = engine.cursor()
         try:
             yield session
-            session.close()
+            engine.commit()
         except Exception as e:
-            session.close()
             engine.rollback()
             raise e
         finally:
             session.close()
-            engine.commit()
+            self._lock.release()
 
-    def _gen_put_sql(self) -> str:
-        return """
-            insert into content_hashes (reference, content_hash, stale_after)
-            values (:reference, :content_hash, :stale_after)
-            on conflict (reference) do update
-            set content_hash = excluded.content_hash,
-            stale_after = excluded.stale_after
-            where reference = excluded.reference
-        """
-        # how to get returning working
+    def _get_many(self, references: list) -> dict:
+        items = {}
+        # chunked, to stay below sqlite's bound parameter limit
+        chunk_size = 500
+        with self._session_scope(self.engine) as session:
+            for start in range(0, len(references), chunk_size):
+                chunk = references[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                session.execute(
+                    f"select * from content_hashes where reference in ({placeholders})",
+                    chunk,
+                )
+                cols = [desc[0] for desc in session.description]
+                for row in session.fetchall():
+                    item = dict(zip(cols, row))
+                    item['content_hash'] = self._decode_hash(item.get('content_hash'))
+                    items[item.get('reference')] = item
+        return items
+
+    hash_column_type = 'blob'
+
+    put_sql = """
+        insert into content_hashes (reference, content_hash, stale_after, size, mtime)
+        values (:reference, :content_hash, :stale_after, :size, :mtime)
+        on conflict (reference) do update
+        set content_hash = excluded.content_hash,
+        stale_after = excluded.stale_after,
+        size = excluded.size,
+        mtime = excluded.mtime
+        where reference = excluded.reference
+    """
+    # how to get returning working
 
-    def _gen_get_sql(self) -> str:
-        return "select * from content_hashes where reference = :reference"
+    get_sql = "select * from content_hashes where reference = :reference"
 
-    def _gen_clean_sql(self) -> str:
-        return "delete from content_hashes where :now > stale_after"
+    clean_sql = "delete from content_hashes where :now > stale_after"
 
 
 class PostgreSQLBackend(GenericDataBaseBackend):
 
-    def _db_init(self, config: dict) -> psycopg2.pool.SimpleConnectionPool:
-        min_conn = 2
-        max_conn = 5
-        dsn = f"dbname={config['dbname']} user={config['user']} password={config['pw']} host={config['host']}"
-        pool = psycopg2.pool.SimpleConnectionPool(
-            min_conn, max_conn, dsn,
+    # batches at least this large bypass inserts
+    # in favour of COPY into a temporary table
+    copy_threshold = 1000
+
+    def _db_init(self, config: dict) -> psycopg_pool.ConnectionPool:
+        conninfo = f"dbname={config['dbname']} user={config['user']} password={config['pw']} host={config['host']}"
+        # sized to the verifier's directory scan thread pool,
+        # so parallel workers are not starved of connections
+        pool = psycopg_pool.ConnectionPool(
+            conninfo,
+            min_size=2,
+            max_size=max(5, os.cpu_count() or 1),
+            timeout=10,
+            # prepare server-side after the first execution,
+            # since the same few statements are run repeatedly
+            kwargs={"prepare_threshold": 1},
         )
         return pool
 
     @contextmanager
     def _session_scope(
         self,
-        pool: psycopg2.pool.SimpleConnectionPool,
-    ) -> ContextManager[psycopg2.extensions.cursor]:
-        engine = pool.getconn()
-        session = engine.cursor()
-        try:
-            yield session
-            session.close()
-        except Exception as e:
-            session.close()
-            engine.rollback()
-            raise e
-        finally:
-            session.close()
-            engine.commit()
-            pool.putconn(engine)
-
-    def _gen_put_sql(self) -> str:
-        return """
-            insert into content_hashes (reference, content_hash, stale_after)
-            values (%(reference)s, %(content_hash)s, %(stale_after)s)
-            on conflict (reference) do update
-            set content_hash = excluded.content_hash,
-            stale_after = excluded.stale_after
-            where content_hashes.reference = excluded.reference
-        """
+        pool: psycopg_pool.ConnectionPool,
+    ) -> ContextManager[psycopg.Cursor]:
+        # the pooled connection commits on success,
+        # and rolls back on exceptions
+        with pool.connection() as engine:
+            with engine.cursor() as session:
+                yield session
+
+    def _put_many(self, items: list) -> bool:
+        items = [
+            (reference, self._encode_hash(content_hash), stale_after, size, mtime)
+            for reference, content_hash, stale_after, size, mtime in items
+        ]
+        with self._session_scope(self.engine) as session:
+            if len(items) >= self.copy_threshold:
+                # COPY into a temporary table, then upsert from there,
+                # since COPY itself cannot resolve conflicts
+                session.execute(
+                    """
+                        create temp table content_hashes_incoming
+                        (like content_hashes) on commit drop
+                    """
+                )
+                with session.copy(
+                    "copy content_hashes_incoming (reference, content_hash, stale_after, size, mtime) from stdin"
+                ) as copy:
+                    for item in items:
+                        copy.write_row(item)
+                session.execute(
+                    """
+                        insert into content_hashes (reference, content_hash, stale_after, size, mtime)
+                        select reference, content_hash, stale_after, size, mtime
+                        from content_hashes_incoming
+                        on conflict (reference) do update
+                        set content_hash = excluded.content_hash,
+                        stale_after = excluded.stale_after,
+                        size = excluded.size,
+                        mtime = excluded.mtime
+                        where content_hashes.reference = excluded.reference
+                    """
+                )
+            else:
+                # pipeline mode sends the whole batch
+                # over one network round trip
+                with session.connection.pipeline():
+                    session.executemany(
+                        self.put_sql,
+                        [
+                            {
+                                "reference": reference,
+                                "content_hash": content_hash,
+                                "stale_after": stale_after,
+                                "size": size,
+                                "mtime": mtime,
+                            }
+                            for reference, content_hash, stale_after, size, mtime in items
+                        ]
+                    )
+        return True
+
+    def _get_many(self, references: list) -> dict:
+        items = {}
+        with self._session_scope(self.engine) as session:
+            session.execute(
+                "select * from content_hashes where reference = any(%(references)s)",
+                {"references": references},
+            )
+            cols = [desc[0] for desc in session.description]
+            for row in session.fetchall():
+                item = dict(zip(cols, row))
+                item['content_hash'] = self._decode_hash(item.get('content_hash'))
+                items[item.get('reference')] = item
+        return items
+
+    hash_column_type = 'bytea'
+
+    put_sql = """
+        insert into content_hashes (reference, content_hash, stale_after, size, mtime)
+        values (%(reference)s, %(content_hash)s, %(stale_after)s, %(size)s, %(mtime)s)
+        on conflict (reference) do update
+        set content_hash = excluded.content_hash,
+        stale_after = excluded.stale_after,
+        size = excluded.size,
+        mtime = excluded.mtime
+        where content_hashes.reference = excluded.reference
+    """
 
-    def _gen_get_sql(self) -> str:
-        return "select * from content_hashes where reference = %(reference)s"
+    get_sql = "select * from content_hashes where reference = %(reference)s"
 
-    def _gen_clean_sql(self) -> str:
-        return "delete from content_hashes where %(now)s > stale_after"
+    clean_sql = "delete from content_hashes where %(now)s > stale_after"
@@ -1,4 +1,5 @@
 
+import heapq
 import os
 import pytest
 import shutil
@@ -7,7 +8,7 @@ import time
 from datetime import datetime, timedelta
 
 import blake3
-import psycopg2
+import psycopg
 
 from tsdapilib.verifier import ContentVerifier
 from tsdapilib.backends import GenericBackend, SQLiteBackend, PostgreSQLBackend
@@ -91,6 +92,14 @@ class TestContentVerifier(object):
             b3.update(open(f1, 'rb').read())
             assert verfied == b3.hexdigest()
 
+            # repeat lookups are served from the cache, not re-hashed
+            cached = verifier.backend.fetch(f1)
+            assert cached is not None
+            assert cached.get('content_hash') == verfied
+            cached['content_hash'] = 'sentinel'
+            assert verifier.check_file(f1) == 'sentinel'
+            cached['content_hash'] = verfied
+
             # incremental processing
             verifier.start(f2)
             for chunk in verifier._lazy_read(f2, chunk_size=2):
@@ -119,6 +128,17 @@ class TestContentVerifier(object):
             verifier.check_directory(target_dir)
             assert verifier.backend.storage.get(f1).get('stale_after') > two_days_ago
 
+            # purging drops expired entries
+            f4 = r.get('files').get('f4')
+            verifier.backend.storage[f4]['stale_after'] = two_days_ago
+            heapq.heappush(verifier.backend.expiry, (two_days_ago, f4))
+            # while a heap tuple left behind by a since refreshed
+            # entry is skipped as a tombstone, keeping the entry
+            heapq.heappush(verifier.backend.expiry, (two_days_ago, f1))
+            verifier.backend.purge()
+            assert verifier.backend.storage.get(f4) is None
+            assert verifier.backend.storage.get(f1) is not None
+
 
     def run_tests_on_verifier_with_backend_and_config(
         self,
@@ -176,7 +196,8 @@ class TestContentVerifier(object):
             assert result is not None
             b3 = blake3.blake3()
             b3.update(open(f2, 'rb').read())
-            assert result[0][0] == b3.hexdigest()
+            # stored as the raw digest bytes
+            assert bytes(result[0][0]) == b3.digest()
 
             # operations on directories
             # with only files
@@ -232,7 +253,7 @@ class TestContentVerifier(object):
                     "host": "localhost",
                 },
             )
-        except psycopg2.OperationalError:
+        except psycopg.OperationalError:
             print("missing postgres setup - skipping test_verifier_postgres")
             print("install postgres, and do:")
             print("createuser apilib_user")
@@ -1,6 +1,10 @@
 
+import functools
 import os
+import stat
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable, Optional
 
 import blake3
@@ -14,6 +18,45 @@ from tsdapilib.exc import (
 )
 
 
+@functools.lru_cache(maxsize=4096)
+def _validate_path(reference: str) -> str:
+    """
+    Ensure a content reference is a valid file path, memoised so
+    repeated checks of the same path skip the syscalls. Existence
+    is judged on the reference itself, without following symlinks,
+    while the directory check follows them, so that a symlink to a
+    directory is rejected like the directory would be. Failures
+    are not cached.
+
+    """
+    try:
+        status = os.lstat(reference)
+    except OSError:
+        raise ContentVerificationMissingReferenceError
+    if stat.S_ISDIR(status.st_mode) or (
+        stat.S_ISLNK(status.st_mode) and os.path.isdir(reference)
+    ):
+        raise ContentVerificationReferenceTypeError
+    return reference
+
+
+def _stat_reference(reference: str) -> os.stat_result:
+    """
+    Stat a file, raising the typed errors when it has gone missing,
+    or has become a directory - for instance changed after an
+    earlier, memoised validation, or mid-way through a directory
+    scan.
+
+    """
+    try:
+        status = os.stat(reference)
+    except OSError:
+        raise ContentVerificationMissingReferenceError
+    if stat.S_ISDIR(status.st_mode):
+        raise ContentVerificationReferenceTypeError
+    return status
+
+
 class ContentVerifier(object):
 
     """
@@ -42,12 +85,21 @@ class ContentVerifier(object):
 
     """
 
+    # files at least this large are hashed with all available
+    # cores - below that, the threading overhead is not worth it
+    multithreading_threshold = 1024 * 1024
+
+    # during directory scans, fresh hashes are flushed to the
+    # backend in batches of this size, while hashing continues
+    store_batch_size = 1000
+
     def __init__(
         self,
         backend: GenericBackend = EphemeralBackend(),
     ) -> None:
         self._backend = backend
         self._buffer = {}
+        self._local = threading.local()
 
     @property
     def backend(self) -> GenericBackend:
@@ -61,16 +113,21 @@ class ContentVerifier(object):
         self,
         reference: str,
         num_bytes: Optional[int] = None,
-        chunk_size: int = 4096,
+        chunk_size: int = 1024 * 1024,
     ) -> Iterable:
         """
-        Read a file, chunk-by-chunk, into an iterable of bytes.
-        If provided, read only until num_bytes, truncating the
-        last chunk size as necessary.
+        Read a file, chunk-by-chunk, into an iterable of bytes-like
+        chunks. If provided, read only until num_bytes, truncating
+        the last chunk size as necessary. Chunks are views into one
+        reused buffer, valid only until the next iteration - which
+        spares an allocation, and a copy, per chunk.
 
         """
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
         with open(reference, 'rb') as f:
             while True:
+                read_size = chunk_size
                 if num_bytes:
                     bytes_read = f.tell()
                     if bytes_read > num_bytes:
@@ -78,13 +135,31 @@ class ContentVerifier(object):
                     elif bytes_read == num_bytes:
                         break
                     elif bytes_read + chunk_size > num_bytes:
-                        # prevent falling into the first branch
-                        chunk_size = num_bytes - bytes_read
-                data = f.read(chunk_size)
-                if not data:
+                        read_size = num_bytes - bytes_read
+                bytes_in = f.readinto(view[:read_size])
+                if not bytes_in:
                     break
                 else:
-                    yield data
+                    yield view[:bytes_in]
+
+    def _get_hasher(self, multithreaded: bool = False) -> blake3.blake3:
+        """
+        Return a reusable, per-thread hash object, reset and ready
+        for a new message, sparing an allocation per hashed file.
+        Only safe for hashes consumed within a single call - the
+        incremental processing buffer keeps dedicated objects.
+
+        """
+        attribute = 'multi' if multithreaded else 'single'
+        b3 = getattr(self._local, attribute, None)
+        if b3 is None:
+            b3 = blake3.blake3(
+                max_threads=blake3.blake3.AUTO if multithreaded else 1,
+            )
+            setattr(self._local, attribute, b3)
+        else:
+            b3.reset()
+        return b3
 
     def _consume_reference(
         self,
@@ -94,9 +169,24 @@ class ContentVerifier(object):
         """
         Consume a given amount of bytes from a file,
         in a memory efficient way, returning the hash
-        object.
+        object. When the whole file is wanted, memory
+        map it, so blake3 can run over the contiguous
+        buffer without a python-level read loop. The
+        chunked fallback serves files that cannot be
+        mapped, such as pipes, and the partial reads
+        done by start(consume=...).
 
         """
+        if num_bytes is None:
+            multithreaded = (
+                _stat_reference(reference).st_size >= self.multithreading_threshold
+            )
+            b3 = self._get_hasher(multithreaded)
+            try:
+                b3.update_mmap(reference)
+                return b3
+            except (OSError, ValueError):
+                pass
         b3 = blake3.blake3()
         for data in self._lazy_read(reference, num_bytes):
             b3.update(data)
@@ -107,57 +197,147 @@ class ContentVerifier(object):
         Ensure the content reference is a valid file path.
 
         """
-        if not os.path.lexists(reference):
-            raise ContentVerificationMissingReferenceError
-        if os.path.isdir(reference):
-            raise ContentVerificationReferenceTypeError
-        return reference
+        return _validate_path(reference)
+
+    def _iter_files(self, root: str) -> Iterable:
+        """
+        Yield the paths of all files under a directory, iteratively,
+        using scandir, which serves the type of regular entries from
+        the directory listing itself, without a stat call per entry.
+        Symlinks to files are yielded, while symlinks to directories
+        are not followed, so scans cannot loop.
+
+        """
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+
+    def _prefetch(self, references: list) -> None:
+        """
+        Ask the kernel to start reading the given files into the
+        page cache, so that hashing overlaps the disk reads rather
+        than waiting on each in turn. Purely advisory - a no-op
+        where posix_fadvise is unavailable, and errors on single
+        files are left for the subsequent read to report.
+
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        for reference in references:
+            try:
+                fd = os.open(reference, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue
+
+    @staticmethod
+    def _stat_matches(item: dict, status: os.stat_result) -> bool:
+        """
+        Whether a cached item was recorded for content with the
+        same size and mtime as the file currently on disk. Items
+        stored without stat information never match, and are
+        re-hashed.
+
+        """
+        return (
+            item.get('size') == status.st_size
+            and item.get('mtime') == status.st_mtime_ns
+        )
+
+    def _hash_reference(self, reference: str) -> tuple:
+        """
+        Hash a file, returning its hexdigest along with the size
+        and mtime of the content, taken before hashing, so that a
+        concurrent modification invalidates the entry rather than
+        going unnoticed.
+
+        """
+        status = _stat_reference(reference)
+        content_hash = self._consume_reference(reference).hexdigest()
+        return content_hash, status.st_size, status.st_mtime_ns
 
     # public methods
 
     def check_file(self, reference: str, force: bool = False) -> Optional[str]:
         """
-        Return the blake3 hexdigest of a file - either from the cache,
-        or if that was stale or missing, update the cache with a fresh
-        hash, and return it.
+        Return the blake3 hexdigest of a file - from the cache, when
+        the entry is fresh and the file's size and mtime still match
+        the entry, or if not, update the cache with a fresh hash, and
+        return it. The stale_after expiry thereby acts as a safety
+        ceiling, while unchanged files cost a stat and a lookup.
 
         """
         reference = self._check_path(reference)
+        status = _stat_reference(reference)
         cached = self.backend.fetch(reference)
-        if cached and not force:
+        if cached and not force and self._stat_matches(cached, status):
             return cached.get('content_hash')
         else:
-            content_hash = self._consume_reference(reference).hexdigest()
-            self.backend.store(reference, content_hash)
+            content_hash, size, mtime = self._hash_reference(reference)
+            self.backend.store(reference, content_hash, size=size, mtime=mtime)
             return content_hash
 
     def check_directory(self, reference: str, force: bool = False) -> Optional[dict]:
         """
         Scan a directory, returning a dict of paths, and their hashes.
         Behaves the same as check_file, in terms of interaction with
-        the cache, on the individual file level.
+        the cache, on the individual file level. Cache entries are
+        prefetched in one query, and only the misses are hashed,
+        concurrently, since blake3 releases the GIL while it works.
 
         """
         if not os.path.lexists(reference):
             raise ContentVerificationMissingReferenceError
         elif not os.path.isdir(reference):
             raise ContentVerificationReferenceTypeError
+        references = list(self._iter_files(reference))
+        cached = {} if force else self.backend.fetch_many(references)
         out = {}
-        for directory, subdirectory, files in os.walk(reference):
-            for file in files:
-                reference = f"{directory}/{file}"
-                content_hash = self.check_file(reference, force)
-                out[reference] = content_hash
+        misses = []
+        for reference in references:
+            item = cached.get(reference)
+            if item and self._stat_matches(item, _stat_reference(reference)):
+                out[reference] = item.get('content_hash')
+            else:
+                misses.append(reference)
+        self._prefetch(misses)
+        # drain hashes as the workers produce them, flushing full
+        # batches to the backend while hashing continues, so disk
+        # reads, hashing, and database writes overlap
+        batch = []
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            hashes = executor.map(self._hash_reference, misses)
+            for miss, (content_hash, size, mtime) in zip(misses, hashes):
+                out[miss] = content_hash
+                batch.append((miss, content_hash, size, mtime))
+                if len(batch) >= self.store_batch_size:
+                    self.backend.store_many(batch)
+                    batch = []
+        if batch:
+            self.backend.store_many(batch)
         return out
 
     def start(self, reference: str, consume: int = 0) -> None:
         """
         Initialise a hash object, optionally consuming some
         part of a given file. Buffer the initialised object
-        on the instance.
+        on the instance. The incremental methods stat their
+        reference on every call, rather than trusting the
+        memoised validation, since they are called over time,
+        during which the path can change underneath them.
 
         """
         reference = self._check_path(reference)
+        _stat_reference(reference)
         if consume:
             self.buffer[reference] = self._consume_reference(
                 reference, num_bytes=consume,
@@ -172,6 +352,7 @@ class ContentVerifier(object):
 
         """
         reference = self._check_path(reference)
+        _stat_reference(reference)
         b3 = self.buffer.get(reference)
         if not b3:
             raise ContentVerificationMissingHashError
@@ -186,6 +367,7 @@ class ContentVerifier(object):
 
         """
         reference = self._check_path(reference)
+        _stat_reference(reference)
         b3 = self.buffer.get(reference)
         if not b3:
             raise ContentVerificationMissingHashError